@@ -1,39 +1,49 @@
 #  Copyright (c) Ioannis E. Kommas. All Rights Reserved 2024.
 
 import os
+import multiprocessing
+import re
+from bisect import bisect_right
+from operator import itemgetter
+from types import MappingProxyType
 import subprocess
 import sys
 import logging
 import pandas as pd
-import tabula
-from PyPDF2 import PdfReader
-import openpyxl
 
 # CONSTANTS
 OUTPUT_FILE_NAME = 'output.xlsx'
 INPUT_FILE_NAME = 'INVOICE'
 cwd = os.getcwd()
 FOLDER = f'{cwd}/{INPUT_FILE_NAME}'
+# Words whose vertical midpoints are closer than this (in points) belong to the same row
+ROW_TOLERANCE = 3
+# A horizontal gap wider than this fraction of the word height starts a new cell
+CELL_GAP_RATIO = 0.5
+# Everything that is not part of a number in the quantity column
+NON_NUMERIC_PATTERN = re.compile(r'[^\d.,]')
 
 """
     '(top, left, bottom, right)'
+    A supplier may also set 'boundaries': the x positions (in points) separating its columns,
+    like tabula's 'columns' option. Without them the columns are inferred from each page.
 """
-area_to_check = {'WRONG AREA': (225, 51, 240, 94),
-                 'BAZAAR': (52.3, 420, 63, 466), }
-
-suppliers = {'094384144': {'area': (290, 0, 585, 595),
-                           'columns': [1, 0, 3, 6, 7, 8, 9, 10],
-                           'names': {1: 'ΠΕΡΙΓΡΑΦΗ',
-                                     0: 'ΚΩΔΙΚΟΣ',
-                                     3: 'ΠΟΣΟΤΗΤΑ',
-                                     6: 'ΤΙΜΗ',
-                                     7: 'ΕΚΠΤΩΣΗ Α',
-                                     8: 'ΕΚΠΤΩΣΗ Β',
-                                     9: 'ΕΦΚ',
-                                     10: 'ΚΟΣΤΟΣ'
-                                     }
-                           },
-             }
+area_to_check = MappingProxyType({'WRONG AREA': (225, 51, 240, 94),
+                                  'BAZAAR': (52.3, 420, 63, 466), })
+
+suppliers = MappingProxyType({'094384144': {'area': (290, 0, 585, 595),
+                                            'columns': (1, 0, 3, 6, 7, 8, 9, 10),
+                                            'names': {1: 'ΠΕΡΙΓΡΑΦΗ',
+                                                      0: 'ΚΩΔΙΚΟΣ',
+                                                      3: 'ΠΟΣΟΤΗΤΑ',
+                                                      6: 'ΤΙΜΗ',
+                                                      7: 'ΕΚΠΤΩΣΗ Α',
+                                                      8: 'ΕΚΠΤΩΣΗ Β',
+                                                      9: 'ΕΦΚ',
+                                                      10: 'ΚΟΣΤΟΣ'
+                                                      }
+                                            },
+                              })
 
 
 def setup_pandas_display_options():
@@ -47,106 +57,71 @@ def setup_pandas_display_options():
     pd.set_option("display.max_rows", 1000)
 
 
-def setup_logging():
+def setup_logging(filemode='w'):
     """
     This function sets up basic logging configuration which writes logs of
     all severity levels equal to or above INFO to a file named 'app.log'.
     The log format includes logger name, severity level, and the message.
+    The file is truncated by default; worker processes pass filemode='a' to append to it.
     """
     logging.basicConfig(filename='app.log',
-                        filemode='w',
+                        filemode=filemode,
                         format='%(name)s - %(levelname)s - %(message)s',
                         level=logging.INFO)
     logger = logging.getLogger(__name__)
     return logger
 
 
+def setup_worker():
+    """
+    Initializes a worker process of the invoice pool, setting up the logging and the pandas
+    display options the same way the main process does.
+    """
+    global logger
+    logger = setup_logging(filemode='a')
+    setup_pandas_display_options()
+
+
 def get_files_in_directory(directory_path):
     """
-        This function lists all the files in a directory provided
-        and returns the first file if any found.
+        This function lists all the PDF files in a directory provided.
 
         :param directory_path: str, The path of the directory
-        :returns: str or None, The first file in the directory or None for empty directory or directories without files
+        :returns: list, The sorted names of the PDF files in the directory, empty for directories without PDF files
     """
-    files = [f for f in os.listdir(directory_path) if os.path.isfile(os.path.join(directory_path, f))]
-    if files:
-        print(files[0])
-        return files[0]
-    else:
-        return None
+    with os.scandir(directory_path) as entries:
+        return sorted(entry.name for entry in entries
+                      if entry.is_file() and entry.name.lower().endswith('.pdf'))
 
 
-def get_pdf_size(file_path):
+def get_pdf_size(pdf):
     """
         Retrieves the dimensions (width and height) of the first page of a PDF file.
 
         Parameters:
-        file_path (string): A string with the system path to the PDF file.
+        pdf (dict): The handle of the opened PDF file as returned by open_pdf().
 
         Returns:
         tuple: A tuple containing the width and height of the first page. If there is an error, it will raise an Exception.
 
 
         """
-    logger.info(f"Getting PDF size for {file_path}")
-    with open(file_path, 'rb') as f:
-        try:
-            pdf = PdfReader(f)
-            page = pdf.pages[0]
-            logger.info(f"Successfully got PDF size for {file_path}")
-            return page.mediabox[2], page.mediabox[3]
-        except Exception as e:
-            logger.error(f"Error occurred while getting PDF size: {e}")
-            raise
-
-
-def adjust_column_width(filename):
-    """
-        Adjusts the width of columns in an Excel file for better readability. Each column width
-        is set to the length of the longest cell value in that column.
-
-        Parameters:
-        filename (str): A string containing the system path to the Excel file.
-
-        Returns:
-        None. The function modifies the Excel file directly.
-
-        Raises:
-        Exception: If there's an error in processing the Excel file, an Exception is raised with a
-        description of the error.
-    """
-    logger.info(f"Adjusting column width for {filename}")
-
+    logger.info(f"Getting PDF size for {pdf['path']}")
     try:
-        wb = openpyxl.load_workbook(filename)
-        sheet = wb.active
-
-        for column in sheet.columns:
-            max_length = 0
-            column = [cell for cell in column]
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(cell.value)
-                except Exception as e:
-                    pass
-            adjusted_width = (max_length + 2)
-            sheet.column_dimensions[column[0].column_letter].width = adjusted_width
-
-        wb.save(filename)
-        logger.info(f"Successfully adjusted column width for {filename}")
+        mediabox = pdf['mediabox']
+        logger.info(f"Successfully got PDF size for {pdf['path']}")
+        return mediabox[2], mediabox[3]
     except Exception as e:
-        logger.error(f"Error occurred while adjusting column width: {e}")
+        logger.error(f"Error occurred while getting PDF size: {e}")
         raise
 
 
-def print_file_size(unique_file):
+def print_file_size(pdf):
     """
     Prints the width and height of the first page of a given PDF file to the logger.
 
     Parameters:
-    file (str): A string containing the system path to the PDF file.
+    pdf (dict): The handle of the opened PDF file as returned by open_pdf().
 
     Returns:
     None. The function directly logs the width and height of the PDF file.
@@ -157,133 +132,324 @@ def print_file_size(unique_file):
     """
 
     try:
-        width, height = get_pdf_size(unique_file)
+        width, height = get_pdf_size(pdf)
         logger.info(f'The PDF size is {width} points wide and {height} points high.')
     except Exception as e:
         logger.error(f"Error occurred while printing file size: {e}")
         raise
 
 
-def create_dataframe(unique_file, area, columns, names):
+def open_pdf(unique_file):
+    """
+    Opens a PDF file once with PyMuPDF and returns a handle that is passed to every step
+    of the process, so the file is parsed a single time.
+
+    Parameters:
+    unique_file (str): A string containing the system path to the PDF file.
+
+    Returns:
+    dict: The handle of the PDF file with the keys 'path', 'document', 'first_page' (the loaded
+          first page), 'mediabox' (of the first page) and 'words' (a cache of the words of each
+          page, filled by get_page_words()).
+    """
+    import pymupdf
+
+    logger.info(f"Opening PDF {unique_file}")
+    document = pymupdf.open(unique_file)
+    first_page = document[0]
+    return {'path': unique_file,
+            'document': document,
+            'first_page': first_page,
+            'mediabox': tuple(first_page.mediabox),
+            'words': {}, }
+
+
+def get_page_words(pdf, page_number):
+    """
+    Returns the words of a page of the PDF file, extracting them only on first use.
+
+    Parameters:
+    pdf (dict): The handle of the opened PDF file as returned by open_pdf().
+    page_number (int): The zero based number of the page.
+
+    Returns:
+    list: The words of the page as returned by PyMuPDF's page.get_text('words').
+    """
+    words = pdf['words'].get(page_number)
+    if words is None:
+        words = pdf['words'][page_number] = pdf['document'][page_number].get_text("words")
+    return words
+
+
+def area_to_rect(area):
+    """
+    Converts an area given as '(top, left, bottom, right)' into a PyMuPDF Rect.
+
+    Parameters:
+    area (tuple): A tuple containing the area of the page in points.
+
+    Returns:
+    Rect: The same area as a PyMuPDF rectangle '(x0, y0, x1, y1)'.
+    """
+    import pymupdf
+
+    top, left, bottom, right = area
+    return pymupdf.Rect(left, top, right, bottom)
+
+
+def group_words(words, area, boundaries=None):
+    """
+    Groups the words found inside an area of a page into the rows of a table.
+
+    Words are grouped into rows by their vertical midpoint. With boundaries, each word goes to
+    the column its horizontal midpoint falls in. Without them, consecutive words of a row are
+    merged into cells and cells are aligned into columns by their horizontal position across
+    all rows of the area.
+
+    Parameters:
+    words (list): The words of a page as returned by get_page_words().
+    area (tuple): A tuple containing the area of the page as '(top, left, bottom, right)'.
+    boundaries (tuple): The x positions separating the columns, or None to infer the columns.
+
+    Returns:
+    list: A list of row tuples, with one value per column. Values are kept as strings,
+          empty cells are None.
+    """
+    top, left, bottom, right = area
+    words = [w for w in words
+             if left <= (w[0] + w[2]) / 2 <= right and top <= (w[1] + w[3]) / 2 <= bottom]
+
+    # Group words into rows
+    rows = []
+    row_mid = None
+    for word in sorted(words, key=lambda w: (w[1] + w[3]) / 2):
+        mid = (word[1] + word[3]) / 2
+        if row_mid is None or mid - row_mid > ROW_TOLERANCE:
+            rows.append([])
+            row_mid = mid
+        rows[-1].append(word)
+
+    if boundaries is not None:
+        data = []
+        for row in rows:
+            values = [None] * (len(boundaries) + 1)
+            for x0, y0, x1, y1, text, *_ in sorted(row, key=lambda w: w[0]):
+                index = bisect_right(boundaries, (x0 + x1) / 2)
+                values[index] = text if values[index] is None else f'{values[index]} {text}'
+            data.append(tuple(values))
+        return data
+
+    # Merge the words of each row into cells as [x0, x1, text]
+    table = []
+    for row in rows:
+        cells = []
+        for x0, y0, x1, y1, text, *_ in sorted(row, key=lambda w: w[0]):
+            if cells and x0 - cells[-1][1] <= (y1 - y0) * CELL_GAP_RATIO:
+                cells[-1][1] = x1
+                cells[-1][2] = f'{cells[-1][2]} {text}'
+            else:
+                cells.append([x0, x1, text])
+        table.append(cells)
+
+    # Merge overlapping cell spans into column spans
+    spans = []
+    for x0, x1, _ in sorted((cell for cells in table for cell in cells), key=lambda c: c[0]):
+        if spans and x0 <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], x1)
+        else:
+            spans.append([x0, x1])
+
+    data = []
+    for cells in table:
+        values = [None] * len(spans)
+        for x0, x1, text in cells:
+            index = next(i for i, span in enumerate(spans) if span[0] <= x0 <= span[1])
+            values[index] = text if values[index] is None else f'{values[index]} {text}'
+        data.append(tuple(values))
+    return data
+
+
+def extract_page(pdf, page_number, area, boundaries=None):
+    """
+    Extracts the words found inside an area of a page as the rows of a table.
+
+    Parameters:
+    pdf (dict): The handle of the opened PDF file as returned by open_pdf().
+    page_number (int): The zero based number of the page.
+    area (tuple): A tuple containing the area of the page as '(top, left, bottom, right)'.
+    boundaries (tuple): The x positions separating the columns, or None to infer the columns.
+
+    Returns:
+    list: A list of row tuples as returned by group_words().
+    """
+    return group_words(get_page_words(pdf, page_number), area, boundaries)
+
+
+def create_dataframe(pdf, area, columns, names, boundaries=None):
     """
     Creates a pandas DataFrame from the contents of a given PDF file.
 
-    It reads data from all pages of the PDF, cleans up and rearranges columns,
-    and finally concatenates into one unified DataFrame.
+    It reads the rows of all pages of the PDF, builds one unified DataFrame from them,
+    and finally cleans up and rearranges its columns.
 
     Parameters:
-    file (str): A string containing the system path to the PDF file.
+    pdf (dict): The handle of the opened PDF file as returned by open_pdf().
+    area (tuple): A tuple containing the area of the page as '(top, left, bottom, right)'.
+    columns (tuple): The indexes of the columns to keep, in output order.
+    names (dict): The output name of each kept column.
+    boundaries (tuple): The x positions separating the columns, or None to infer the columns.
 
     Returns:
     DataFrame: A pandas DataFrame containing data processed from the PDF file.
+
+    Raises:
+    ValueError: If a row of a page has fewer columns than the ones to keep.
     """
-    CODE_COLUMN = 'ΚΩΔΙΚΟΣ'
-    # Create empty list to hold dataframes
-    dfs = []
-
-    # Read data from all pages
-    df_list = tabula.read_pdf(unique_file, pages='all', area=area, guess=False, pandas_options={'header': None})
-    # Iterate over list of dataframes and add each to dfs
-    for df in df_list:
-        df[3] = df[3].replace({r'[^\d\.\,]': ''}, regex=True)
-        df = df[columns]
-        dfs.append(df)
-
-    # Concatenate dataframes along rows
-    final_df = pd.concat(dfs).reset_index(drop=True)
-    final_df = final_df.rename(columns=names)
-    logger.info(final_df)
-    final_df[CODE_COLUMN] = final_df[CODE_COLUMN].astype(str)
+    # Read the rows of all pages in page order. Pages are extracted one after the other,
+    # as a PyMuPDF document must not be used from more than one thread.
+    # Only the requested columns of each row are kept.
+    select = itemgetter(*columns)
+    width = max(columns) + 1
+    rows = []
+    for page_number in range(pdf['document'].page_count):
+        for row in extract_page(pdf, page_number, area, boundaries):
+            if len(row) < width:
+                raise ValueError(f"Page {page_number + 1} has {len(row)} columns but column {width - 1} is needed, "
+                                 f"set the 'boundaries' of the supplier: {row}")
+            rows.append(select(row))
+
+    # Build the DataFrame once from the rows of all pages, already with the final column names,
+    # then clean up the quantity column
+    final_df = pd.DataFrame.from_records(rows, columns=[names[column] for column in columns])
+    quantity_column = names[3]
+    final_df[quantity_column] = final_df[quantity_column].str.replace(NON_NUMERIC_PATTERN, '', regex=True)
+    logger.info("DataFrame shape=%s columns=%s", final_df.shape, list(final_df.columns))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", final_df.head())
     return final_df
 
 
-def save_and_open(df):
+def save_and_open(df, output_file=OUTPUT_FILE_NAME, open_file=True):
     """
     Saves a provided pandas DataFrame to an Excel file, adjusts the column widths for readability,
     and opens the file automatically.
 
     Parameters:
     df (DataFrame): A pandas DataFrame that needs to be saved to an Excel file.
+    output_file (str): The path of the Excel file, 'output.xlsx' by default.
+    open_file (bool): Whether to open the Excel file once saved, True by default.
 
     Returns:
     None. The function saves the DataFrame to an Excel file and opens it.
     """
 
-    # Save your DataFrame to an Excel file
-    df.to_excel(OUTPUT_FILE_NAME, index=False)
-    # Adjust the column width of the Excel file
-    adjust_column_width(OUTPUT_FILE_NAME)
+    # Width of each column is the length of its longest value, header included
+    widths = [max(len(str(column)), df[column].fillna('').astype(str).str.len().max()) + 2
+              for column in df.columns]
+    # Save your DataFrame to an Excel file, setting the column widths while writing
+    with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False)
+        sheet = writer.sheets['Sheet1']
+        for index, width in enumerate(widths):
+            sheet.set_column(index, index, width)
     # Open the Excel file
-    subprocess.run(['open', OUTPUT_FILE_NAME], check=True)
+    if open_file:
+        subprocess.run(['open', output_file], check=True)
 
 
-def main(unique_supplier_id):
+def main(pdf, unique_supplier_id, output_file=OUTPUT_FILE_NAME, open_file=True):
     """
     Launches the main process for the script.
 
-    It gets the current working directory and constructs a file path for 'invoice.pdf' file in it.
-    If the file exists, it gets the file size, converts the data into a pandas DataFrame,
-    saves the DataFrame into 'output.xlsx', and opens the Excel file.
+    It gets the file size of the already opened PDF file, converts the data into a pandas DataFrame,
+    saves the DataFrame into the output file ('output.xlsx' by default), and opens the Excel file
+    unless open_file is False.
 
-    If at any point an error occurs, it logs the error message and exits with status code 1.
+    Returns:
+    bool: True on success. If at any point an error occurs, it logs the error message and returns False.
     """
-    area = suppliers[unique_supplier_id].get('area')
-    columns = suppliers[unique_supplier_id].get('columns')
-    names = suppliers[unique_supplier_id].get('names')
+    supplier = suppliers[unique_supplier_id]
+    area, columns, names = supplier['area'], supplier['columns'], supplier['names']
+    boundaries = supplier.get('boundaries')
 
+    try:
+        print_file_size(pdf)
+        df = create_dataframe(pdf, area, columns, names, boundaries)
+        save_and_open(df, output_file, open_file)
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        return False
+    return True
+
+
+def process_one_invoice(file_name, output_file=OUTPUT_FILE_NAME, open_file=True):
+    """
+    Runs the whole process for one invoice of the input folder: opens the PDF file, finds its
+    supplier, and saves its data into an Excel file.
+
+    Parameters:
+    file_name (str): The name of the PDF file inside the input folder.
+    output_file (str): The path of the Excel file, 'output.xlsx' by default.
+    open_file (bool): Whether to open the Excel file once saved, True by default.
+
+    Returns:
+    bool: True if the invoice was converted, False otherwise.
+    """
+    print(file_name)
+    file = f'{FOLDER}/{file_name}'
     if not os.path.exists(file):
         logger.error(f"File {file} does not exist.")
-        sys.exit(1)
+        return False
     try:
-        print_file_size(file)
-        df = create_dataframe(file, area, columns, names)
-        save_and_open(df)
+        pdf_file = open_pdf(file)
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
-        sys.exit(1)
+        logger.error(f"Error occurred while opening {file}: {e}")
+        return False
+    try:
+        supplier_id = find_suppliers(pdf_file)
+        if supplier_id is None:
+            logger.error(f"No known supplier found in {file}.")
+            return False
+        return main(pdf_file, supplier_id, output_file, open_file)
+    finally:
+        pdf_file['document'].close()
 
 
-def read_supplier_unique_number(unique_file, area):
+def read_supplier_unique_number(pdf, area):
     """
     Retrieves the supplier's unique number from a given area of the PDF file.
 
     Parameters:
-    unique_file (str): A string containing the system path to the PDF file.
-    area (tuple): A tuple containing the areas of the page to be read as per the tabula.read_pdf() syntax.
+    pdf (dict): The handle of the opened PDF file as returned by open_pdf().
+    area (tuple): A tuple containing the area of the page to be read as '(top, left, bottom, right)'.
 
     Returns:
     str: The supplier's unique number as a string. It directly matches a key in the global 'suppliers' dictionary.
          If the supplier's unique number is not found or a pdf reading error occurs, it returns None.
 
     Note:
-    This function uses the tabula.read_pdf() method to read a given area of the PDF file as a dataframe
-    The supplier's unique number is assumed to be in the first cell (0,0) of the dataframe.
+    This function reads the text inside a given area of the first page of the PDF file.
+    The supplier's unique number is assumed to be the first line of that text.
 
     """
     try:
-        df = tabula.read_pdf(unique_file, pages='all', area=area, guess=False,
-                             pandas_options={'header': None, 'dtype': str})[0]
+        text = pdf['first_page'].get_text("text", clip=area_to_rect(area))
     except Exception as e:
-        print('No Dataframe Available Here', e)
-        return
-    try:
-        if not df.empty:
-            answer = df[0].values[0]
-            if answer in suppliers.keys():
-                return answer
-            else:
-                print("\033[91m {}\033[00m".format(f'{answer} not in keys'))
-    except Exception as e:
-        print("\033[91m {}\033[00m".format(e))
+        logger.warning(f"No text available in area {area}: {e}")
         return None
+    answer = text.strip().split('\n', 1)[0].strip()
+    if answer in suppliers:
+        return answer
+    logger.debug("%s not in keys", answer)
+    return None
 
 
-def find_suppliers(unique_file):
+def find_suppliers(pdf):
     """
     Iterates over a predefined list of areas in the PDF file and attempts to find a supplier's unique number in each one.
 
     Parameters:
-    unique_file (str): A string specifying the system path to the PDF file.
+    pdf (dict): The handle of the opened PDF file as returned by open_pdf().
 
     Returns:
     str or None : The supplier's unique number as a string if found. If no supplier number is found in any of the defined areas, will return None.
@@ -291,22 +457,32 @@ def find_suppliers(unique_file):
     Note:
     This function relies on the 'area_to_check' dictionary (defined globally). The keys of this dictionary represent identifiers for the positions in the document, and the values are coordinates for the areas to check on the PDF file.
     These areas are used to extract information which is then tested for presence in the 'suppliers' dictionary.
-    The function outputs progress to the console and returns as soon as a valid supplier number is identified.
+    The function logs its progress at DEBUG level and returns as soon as a valid supplier number is identified.
     """
-    for key in area_to_check:
-        value = area_to_check[key]
-        print(f"Checking: {key} Position")
-        unique_supplier_id = read_supplier_unique_number(unique_file, value)
+    for key, value in area_to_check.items():
+        logger.debug("Checking: %s Position", key)
+        unique_supplier_id = read_supplier_unique_number(pdf, value)
         if unique_supplier_id is not None:
-            print("\033[92m {}\033[00m".format(f'Position for {key} Worked!'))
+            logger.debug("Position for %s Worked!", key)
             return unique_supplier_id
-        else:
-            print(f"Nothing Found Checking Next Key")
+        logger.debug("Nothing Found Checking Next Key")
 
 
 if __name__ == "__main__":
     logger = setup_logging()
     setup_pandas_display_options()
-    file = f'{FOLDER}/{get_files_in_directory(FOLDER)}'
-    supplier_id = find_suppliers(file)
-    main(supplier_id)
+    files = get_files_in_directory(FOLDER)
+    if not files:
+        logger.error(f"No invoices found in {FOLDER}.")
+        sys.exit(1)
+    if len(files) == 1:
+        results = [process_one_invoice(files[0])]
+    else:
+        # One output file per invoice, named after it, each invoice in its own process.
+        # The output files are not opened, to avoid one Excel window per invoice.
+        jobs = [(file_name, f'{os.path.splitext(file_name)[0]}_{OUTPUT_FILE_NAME}', False) for file_name in files]
+        processes = min(os.cpu_count() or 1, len(files))
+        with multiprocessing.Pool(processes=processes, initializer=setup_worker) as pool:
+            results = pool.starmap(process_one_invoice, jobs)
+    if not all(results):
+        sys.exit(1)
@@ -0,0 +1,59 @@
+#  Copyright (c) Ioannis E. Kommas. All Rights Reserved 2024.
+
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+AREA = (100, 0, 200, 300)
+BOUNDARIES = (50, 100, 150)
+
+
+def word(x0, x1, y, text):
+    """
+    Builds a word as returned by PyMuPDF's page.get_text('words'), 8 points high around y.
+    """
+    return x0, y - 4, x1, y + 4, text, 0, 0, 0
+
+
+def test_group_words_infers_columns():
+    words = [word(10, 30, 120, 'A1'), word(60, 80, 120, 'Long'), word(82, 95, 120, 'name'),
+             word(10, 30, 140, 'A2'), word(60, 80, 140, 'Short')]
+    assert app.group_words(words, AREA) == [('A1', 'Long name'), ('A2', 'Short')]
+
+
+def test_group_words_skips_words_outside_area():
+    words = [word(10, 30, 120, 'A1'), word(10, 30, 250, 'Footer')]
+    assert app.group_words(words, AREA) == [('A1',)]
+
+
+def test_group_words_with_boundaries_keeps_empty_columns():
+    words = [word(10, 30, 120, 'A1'), word(60, 80, 120, 'Name'), word(160, 180, 120, '9,99'),
+             word(10, 30, 140, 'A2'), word(60, 80, 140, 'Other'), word(160, 180, 140, '1,00')]
+    assert app.group_words(words, AREA, BOUNDARIES) == [('A1', 'Name', None, '9,99'),
+                                                        ('A2', 'Other', None, '1,00')]
+
+
+def test_group_words_with_boundaries_does_not_shift_columns():
+    words = [word(10, 30, 120, 'A1'), word(60, 80, 120, 'Name'), word(110, 130, 120, '2'),
+             word(160, 180, 120, '9,99'), word(85, 98, 120, 'wrapped')]
+    assert app.group_words(words, AREA, BOUNDARIES) == [('A1', 'Name wrapped', '2', '9,99')]
+
+
+def test_create_dataframe_rejects_narrow_rows(monkeypatch):
+    monkeypatch.setattr(app, 'logger', logging.getLogger(__name__), raising=False)
+    pdf = {'document': SimpleNamespace(page_count=1),
+           'words': {0: [word(10, 30, 120, 'A1'), word(60, 80, 120, 'Name')]}, }
+    with pytest.raises(ValueError, match='Page 1 has 2 columns but column 3 is needed'):
+        app.create_dataframe(pdf, AREA, (1, 0, 3), {1: 'B', 0: 'A', 3: 'D'})
+
+
+def test_create_dataframe_with_boundaries(monkeypatch):
+    monkeypatch.setattr(app, 'logger', logging.getLogger(__name__), raising=False)
+    pdf = {'document': SimpleNamespace(page_count=1),
+           'words': {0: [word(10, 30, 120, 'A1'), word(160, 180, 120, '3TEM')]}, }
+    df = app.create_dataframe(pdf, AREA, (3, 0, 1), {3: 'QTY', 0: 'CODE', 1: 'NAME'}, BOUNDARIES)
+    assert list(df.columns) == ['QTY', 'CODE', 'NAME']
+    assert df.iloc[0].tolist() == ['3', 'A1', None]